@@ -15,16 +15,27 @@ links.
 For more details on building multi-page Dash applications, check out the Dash
 documentation: https://dash.plot.ly/urls
 """
+import functools
+import hashlib
+import json
+import logging
+from urllib.parse import quote
+
+import flask
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_bootstrap_components as dbc
 import dash_table
 import dash_auth
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, ALL
+from dash.exceptions import PreventUpdate
 
+import numpy as np
 import pandas as pd
 
+from shards import shard_paths, search_shards, start_shard_servers, phrase_matches, rank
+
 # for text_preprocessing
 from bs4 import BeautifulSoup
 import unidecode
@@ -113,7 +124,120 @@ def text_preprocessing(text, accented_chars=True, contractions=True,
     return ' '.join(clean_text)
 
 # ===== Data =====
-data = pd.read_pickle('data/data-3-results.pickle')
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DATA_PATH = 'data/data-3-results.pickle'
+
+
+def file_hash(path):
+    """sha1 of a file, read in chunks"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def memory_mb(df):
+    """deep memory usage of a DataFrame in MB"""
+    return df.memory_usage(deep=True).sum() / 1024 ** 2
+
+
+def derive_text(df):
+    """build Text = HSDescCleaned + Alpha on demand instead of storing it"""
+    cleaned = df['HSDescCleaned'].astype(object)
+    return cleaned.str.cat(df['Alpha'].astype(object), sep=' ', na_rep='').str.strip()
+
+
+def with_text(df):
+    """add the derived Text column back for display"""
+    if 'Text' in df.columns:
+        return df
+    return df.assign(Text=derive_text(df))
+
+
+def compact_data(df):
+    """shrink the DataFrame every gunicorn worker holds in memory
+
+    Repeated strings (HSVersions, descriptions shared across HS versions) are
+    stored once as categoricals, so each row only keeps an integer code.
+    Text is dropped when it can be rebuilt from HSDescCleaned + Alpha.
+    """
+    df = df.reset_index(drop=True)
+    if 'Text' in df.columns:
+        # rows with no stored Text have nothing to disagree with
+        stored = df['Text'].astype(object)
+        present = stored.notna()
+        differ = (derive_text(df)[present] != stored[present].str.strip()).sum()
+        if differ:
+            logger.info('Text kept: %d rows differ from HSDescCleaned + Alpha', differ)
+        else:
+            df = df.drop(columns='Text')
+            logger.info('Text dropped, rebuilt from HSDescCleaned + Alpha when shown')
+    for col in ['HSVersions', 'HSDesc', 'HSDescCleaned', 'Alpha', 'Text', 'Text_Proc1']:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    return df
+
+
+def search_rows(search):
+    """row positions whose Text_Proc1 contains the (processed) search phrase
+
+    The match runs once per distinct text and is mapped back to rows through
+    the integer category codes.
+    """
+    texts = data['Text_Proc1'].cat
+    hit = phrase_matches(texts.categories, search)
+    # code -1 (missing text) picks up the trailing False
+    hit = np.append(hit, False)
+    return np.flatnonzero(hit[texts.codes])
+
+
+@functools.lru_cache(maxsize=128)
+def matched_rows(search):
+    """search_rows for recent queries, so facet clicks filter the stored match"""
+    rows = search_rows(search)
+    rows.flags.writeable = False
+    return rows
+
+
+def chapter_ids(codes):
+    """HS chapter (first two digits of HSCode) as int8, 0 where it can't be read"""
+    if pd.api.types.is_numeric_dtype(codes):
+        # avoid '10121.0' when the codes were stored as floats
+        codes = codes.astype('Int64')
+    digits = codes.astype(str).str.replace(r'\D', '', regex=True)
+    # HS codes have an even number of digits, an odd count means a lost leading zero
+    digits = digits.where(digits.str.len() % 2 == 0, '0' + digits)
+    chapters = digits.str[:2]
+    chapters = pd.to_numeric(chapters.where(chapters.str.len() == 2), errors='coerce')
+    return chapters.fillna(0).astype(np.int8).to_numpy()
+
+
+def chapter_counts(rows):
+    """number of matched rows per chapter, indexed by chapter number"""
+    return np.bincount(data_chapters[rows], minlength=100)
+
+
+data = pd.read_pickle(DATA_PATH)
+# changes only when the pickle is replaced, so it versions every GET response built from it
+DATA_VERSION = file_hash(DATA_PATH)[:16]
+memory_before = memory_mb(data)
+data = compact_data(data)
+logger.info('Data loaded: %d rows, memory %.1f MB -> %.1f MB',
+            len(data), memory_before, memory_mb(data))
+data_chapters = chapter_ids(data['HSCode'])
+
+DATA_COLUMNS = ['HSVersions', 'HSCode', 'HSDesc', 'HSDescCleaned', 'Alpha', 'Text', 'Text_Proc1']
+RESULT_COLUMNS = ['HSVersions', 'HSCode', 'HSDesc', 'Alpha', 'Text_Proc1']
+
+# token count of each distinct Text_Proc1, to rank HS hits next to the shards
+text_lengths = data['Text_Proc1'].cat.categories.str.split().str.len().to_numpy()
+
+# national schedules under data/shards, served by shard processes shared by all workers
+SHARD_PATHS = shard_paths()
+SHARD_TOP_K = 50
 
 
 
@@ -130,6 +254,7 @@ external_stylesheets = ['https://stackpath.bootstrapcdn.com/bootstrap/4.3.1/css/
 # external_stylesheets = ['https://cdnjs.cloudflare.com/ajax/libs/twitter-bootstrap/3.3.7/css/bootstrap.min.css']
 
 # with "__name__" local css under assets is also included
+# (compress=True by default: Flask-Compress serves Brotli/gzip for JSON, HTML, CSS and JS)
 app = dash.Dash(__name__, external_stylesheets = external_stylesheets)
 
 # auth = dash_auth.BasicAuth(
@@ -311,14 +436,20 @@ def render_page_content(pathname):
                         * Search will be done on this column
                     '''
                     ),
+                html.P([
+                    html.A('Download CSV', href='/export/data.csv', className='mr-3'),
+                    html.A('Download for Excel', href='/export/data.csv?format=excel'),
+                ]),
 
+                # rows come from /api/data, see load_data_table
+                dcc.Store(id='data-version', data=DATA_VERSION),
                 dash_table.DataTable(
                     id='table',
                     # columns=[{"name": i, "id": i} for i in textdata.columns],
                     # data=textdata.to_dict('records'),
 
-                    columns=[{"name": i, "id": i} for i in data[['HSVersions', 'HSCode', 'HSDesc', 'HSDescCleaned', 'Alpha', 'Text', 'Text_Proc1']].columns],
-                    data=data.to_dict('records'),
+                    columns=[{"name": i, "id": i} for i in DATA_COLUMNS],
+                    data=[],
 
                     editable=False,
                     filter_action="native",
@@ -673,26 +804,115 @@ def display_table(n_clicks, search_str):
     search = text_preprocessing(search_str)
     # print(search_str)
     # search = search_str
-    dff = data[data['Text_Proc1'].str.contains(' '+search+' ')][['HSVersions','HSCode', 'HSDesc', 'Alpha', 'Text_Proc1']]
+    rows = matched_rows(search)
+    dff = data.iloc[rows][RESULT_COLUMNS]
+    counts = chapter_counts(rows)
 
     return html.Div([
             # dbc.Alert(str(len(dff)) + ' papragraphs found for selection criteria: member = "' + dropdown_value_gov_1 + '", search = "' + search_str + '"', color="info"),
             html.Blockquote(' Results for searching: "' + search_str + '"; Total ' + str(len(dff)) + ' found'),
+            html.P([
+                html.A('Download CSV', href='/export/search.csv?q=' + quote(search_str), className='mr-3'),
+                html.A('Download for Excel', href='/export/search.csv?format=excel&q=' + quote(search_str)),
+            ]),
+            dcc.Store(id='search-query', data=search),
+            dbc.Row([
+                dbc.Col([
+                    html.P('Filter by chapter', style={'font-weight': 'bold'}),
+                    dbc.Button('All (' + str(len(dff)) + ')', id={'type': 'facet-chapter', 'index': 0},
+                               color='info', size='sm', className='mr-1 mb-1'),
+                ] + [
+                    dbc.Button('Chapter {:02d} ({})'.format(chapter, counts[chapter]),
+                               id={'type': 'facet-chapter', 'index': int(chapter)},
+                               color='light', size='sm', className='mr-1 mb-1')
+                    for chapter in np.flatnonzero(counts[1:]) + 1
+                ], width=2),
+                dbc.Col([
+                    dash_table.DataTable(
+                            id='tab',
+                            columns=[
+                                        {"name": i, "id": i, "deletable": False, "selectable": False} for i in dff.columns if i != 'ID'
+                                    ],
+                            data = dff.to_dict('records'),
+                            editable=False,
+                            # filter_action="native",
+                            sort_action="native",
+                            sort_mode="multi",
+                            column_selectable=False,
+                            row_selectable=False,
+                            row_deletable=False,
+                            selected_columns=[],
+                            selected_rows=[],
+                            page_action="native",
+                            page_current= 0,
+                            page_size= 20,
+                            style_cell={
+                                        'height': 'auto',
+                                        'minWidth': '20px', 'maxWidth': '500px',
+                                        'whiteSpace': 'normal',
+                                        'textAlign': 'left',
+                                        'verticalAlign': 'top',
+                                        'fontSize':12,
+                                        },
+                            style_cell_conditional=[
+                                        {'if': {'column_id': 'Symbol'},
+                                         'width': '100px'},
+                                        {'if': {'column_id': 'Member'},
+                                         'width': '70px'},
+                                        {'if': {'column_id': 'ReportDate'},
+                                         'width': '90px'},
+                                        {'if': {'column_id': 'Topic'},
+                                         'width': '200px'},
+                                        {'if': {'column_id': 'ParaID'},
+                                         'width': '40px'},
+                                         ]
+                        )
+                ], width=10),
+            ]),
+            shard_results(search, rows),
+            ]), #csv_string
+
+
+def shard_status(name, state, seconds):
+    if seconds is None:
+        return '{} {}'.format(name, state)
+    if state == 'ok':
+        return '{} {:.0f} ms'.format(name, seconds * 1000)
+    return '{} {} ({:.0f} ms)'.format(name, state, seconds * 1000)
+
+
+def shard_results(search, rows):
+    """HS matches merged with the national shards' top results, with per-shard latency
+
+    Shard problems only show up in the latency line, the HS results above
+    never depend on them.
+    """
+    if not SHARD_PATHS:
+        return html.Div()
+    top, scores = rank(text_lengths[data['Text_Proc1'].cat.codes.to_numpy()[rows]],
+                       len(search.split()), SHARD_TOP_K)
+    hits = [dict(record, Shard='HS', Score=round(float(score), 3)) for record, score in
+            zip(data.iloc[rows[top]][['HSCode', 'HSDesc', 'Text_Proc1']].to_dict('records'), scores)]
+    try:
+        shard_hits, status = search_shards(SHARD_PATHS, search, SHARD_TOP_K)
+    except Exception:
+        app.logger.exception('Shard search failed')
+        shard_hits, status = [], {name: ('failed', None) for name in SHARD_PATHS}
+    for name, (state, seconds) in status.items():
+        if state != 'ok':
+            app.logger.warning('Shard %s %s', name, state)
+    hits = sorted(hits + shard_hits, key=lambda hit: hit['Score'], reverse=True)[:SHARD_TOP_K]
+    return html.Div([
+            html.Br(),
+            html.H5('All nomenclatures: top ' + str(len(hits)), style={'font-weight': 'bold'}),
+            html.P('Shard latency: ' + ', '.join(shard_status(name, *status[name]) for name in SHARD_PATHS),
+                   style={'fontSize': 12}),
             dash_table.DataTable(
-                    id='tab',
-                    columns=[
-                                {"name": i, "id": i, "deletable": False, "selectable": False} for i in dff.columns if i != 'ID'
-                            ],
-                    data = dff.to_dict('records'),
+                    id='tab-shards',
+                    columns=[{"name": i, "id": i} for i in ['Shard', 'HSCode', 'HSDesc', 'Text_Proc1', 'Score']],
+                    data=hits,
                     editable=False,
-                    # filter_action="native",
                     sort_action="native",
-                    sort_mode="multi",
-                    column_selectable=False,
-                    row_selectable=False,
-                    row_deletable=False,
-                    selected_columns=[],
-                    selected_rows=[],
                     page_action="native",
                     page_current= 0,
                     page_size= 20,
@@ -704,20 +924,34 @@ def display_table(n_clicks, search_str):
                                 'verticalAlign': 'top',
                                 'fontSize':12,
                                 },
-                    style_cell_conditional=[
-                                {'if': {'column_id': 'Symbol'},
-                                 'width': '100px'},
-                                {'if': {'column_id': 'Member'},
-                                 'width': '70px'},
-                                {'if': {'column_id': 'ReportDate'},
-                                 'width': '90px'},
-                                {'if': {'column_id': 'Topic'},
-                                 'width': '200px'},
-                                {'if': {'column_id': 'ParaID'},
-                                 'width': '40px'},
-                                 ]
                 )
-            ]), #csv_string
+            ])
+
+
+# Chapter facets: filter the rows matched for the query (kept by matched_rows)
+@app.callback(
+        [Output('tab', 'data'),
+         Output('tab', 'page_current'),
+         Output({'type': 'facet-chapter', 'index': ALL}, 'color')],
+        [Input({'type': 'facet-chapter', 'index': ALL}, 'n_clicks')],
+        [State('search-query', 'data')]
+    )
+def filter_by_chapter(n_clicks, search):
+    if not any(n_clicks):
+        raise PreventUpdate
+    triggered = dash.callback_context.triggered[0]['prop_id'].rsplit('.', 1)[0]
+    chapter = json.loads(triggered)['index']
+    rows = matched_rows(search)
+    if chapter:
+        rows = rows[data_chapters[rows] == chapter]
+    colors = ['info' if i['id']['index'] == chapter else 'light'
+              for i in dash.callback_context.inputs_list[0]]
+    return data.iloc[rows][RESULT_COLUMNS].to_dict('records'), 0, colors
+
+
+
+
+
 
 
 
@@ -730,9 +964,111 @@ def display_table(n_clicks, search_str):
 
 
 
+# ===== HTTP caching =====
+# GET resources built from the data carry an ETag derived from DATA_VERSION, so
+# repeat requests are answered with 304 until the pickle changes.
+def etag_for(*key):
+    """ETag for a response built from the current data and the given key"""
+    return hashlib.sha1('|'.join((DATA_VERSION,) + key).encode('utf-8')).hexdigest()[:20]
+
+
+def client_etag(etag):
+    """the validator the client sent for this version as (tag, weak), or None
+
+    Flask-Compress sends compressed bodies with the ETag "<etag>:br" or
+    "<etag>:gzip", so the encoding suffix is ignored when comparing.
+    """
+    tags = flask.request.if_none_match
+    for tag in tags.as_set(include_weak=True):
+        if tag.split(':')[0] == etag:
+            return tag, not tags.contains(tag)
+    return None
+
+
+def conditional(build, *key):
+    """304 if the client holds the current version, otherwise the response from build()"""
+    etag = etag_for(*key)
+    sent = client_etag(etag)
+    if sent is not None:
+        response = flask.Response(status=304)
+        response.set_etag(*sent)
+    else:
+        response = build()
+        response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, no-cache'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@server.route('/api/data')
+def api_data():
+    return conditional(lambda: flask.Response(with_text(data)[DATA_COLUMNS].to_json(orient='records'),
+                                              mimetype='application/json'), 'data')
+
+
+# The Data page fetches its rows with a GET instead of receiving them in a
+# callback response, so the browser cache revalidates them: a repeat view costs
+# a 304. Dash 1.x clientside callbacks cannot return a promise, hence the
+# synchronous request.
+app.clientside_callback(
+    """
+    function(version) {
+        var xhr = new XMLHttpRequest();
+        xhr.open('GET', '/api/data', false);
+        xhr.send();
+        return xhr.status === 200 ? JSON.parse(xhr.responseText) : [];
+    }
+    """,
+    Output('table', 'data'),
+    [Input('data-version', 'data')]
+)
+
+
+# ===== Export =====
+# CSV is written and sent EXPORT_CHUNK_ROWS rows at a time, so exporting the
+# whole nomenclature never holds more than one chunk as text. text/csv is not in
+# COMPRESS_MIMETYPES, which keeps Flask-Compress from buffering the stream.
+EXPORT_CHUNK_ROWS = 5000
+
+
+def export_chunks(rows, columns, excel=False):
+    """yield data (all rows, or the given row positions) as CSV text in chunks"""
+    if excel:
+        # byte order mark so Excel reads the file as UTF-8
+        yield '\ufeff'
+    total = len(data) if rows is None else len(rows)
+    for start in range(0, max(total, 1), EXPORT_CHUNK_ROWS):
+        stop = start + EXPORT_CHUNK_ROWS
+        chunk = data.iloc[start:stop] if rows is None else data.iloc[rows[start:stop]]
+        if 'Text' in columns:
+            chunk = with_text(chunk)
+        yield chunk[columns].to_csv(index=False, header=(start == 0))
+
+
+def csv_response(chunks, filename):
+    return flask.Response(
+        flask.stream_with_context(chunks),
+        mimetype='text/csv',
+        headers={'Content-Disposition': 'attachment; filename=' + filename},
+    )
+
+
+@server.route('/export/data.csv')
+def export_data():
+    excel = flask.request.args.get('format') == 'excel'
+    return conditional(lambda: csv_response(export_chunks(None, DATA_COLUMNS, excel), 'hs-data.csv'),
+                       'data.csv', str(excel))
 
 
+@server.route('/export/search.csv')
+def export_search():
+    search_str = flask.request.args.get('q', '')
+    excel = flask.request.args.get('format') == 'excel'
 
+    def build():
+        rows = matched_rows(text_preprocessing(search_str))
+        return csv_response(export_chunks(rows, RESULT_COLUMNS, excel), 'hs-search.csv')
+    return conditional(build, 'search.csv', search_str, str(excel))
 
 
 # General modules
@@ -747,4 +1083,6 @@ def toggle_collapse(n, is_open):
     return is_open
 
 if __name__ == '__main__':
+    # under gunicorn the shard servers are started by on_starting in gunicorn.conf.py
+    start_shard_servers(SHARD_PATHS)
     app.run_server(debug=True)
@@ -0,0 +1,7 @@
+"""gunicorn settings, picked up automatically by `gunicorn app:server`"""
+import shards
+
+
+def on_starting(server):
+    # one set of shard servers per host, shared by every worker
+    shards.start_shard_servers(shards.shard_paths())
@@ -0,0 +1,391 @@
+"""
+Sharded search across national tariff schedules.
+
+Every national schedule saved as data/shards/<name>.pickle is one shard. A
+shard pickle needs HSCode, HSDesc and Text_Proc1 columns, with Text_Proc1
+produced and space-padded the same way as in the HS data, since both are
+matched with the same phrase_matches rule. The HS rows are not a shard: the
+app searches its compacted in-process copy and merges the results.
+
+Each shard is served by its own process listening on a local socket, started
+once per host (gunicorn's on_starting hook, or app.py when run directly) and
+shared by all workers. The shard process builds its inverted index before it
+starts listening. A server still running from an older pickle is replaced,
+and a worker that finds a shard with no server restarts it (at most once per
+SHARD_RESTART_INTERVAL). Workers send a query to every shard at once, give
+connecting and answering SHARD_TIMEOUT seconds in total and merge the
+per-shard top-k lists. A shard that is down, fails or is too slow is reported
+as such and left out of the results.
+
+Run one shard server by hand with: python shards.py <name> <path>
+"""
+import atexit
+import fcntl
+import glob
+import heapq
+import os
+import secrets
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, wait as futures_wait
+from multiprocessing.connection import Client, Listener, answer_challenge, deliver_challenge
+
+import numpy as np
+import pandas as pd
+
+SHARD_DIR = 'data/shards'
+SHARD_COLUMNS = ['HSCode', 'HSDesc', 'Text_Proc1']
+SHARD_TIMEOUT = 2.0
+SHARD_START_TIMEOUT = 600
+SHARD_RESTART_INTERVAL = 60
+# shared secret for the shard sockets, set by whoever starts the servers
+SHARD_KEY_ENV = 'HSSEARCH_SHARD_KEY'
+
+# worker side: one open connection per shard, last restart attempt per shard
+_connections = {}
+_restarted = {}
+_lock = threading.Lock()
+
+
+def shard_paths(shard_dir=SHARD_DIR):
+    """shard name -> pickle path"""
+    return {os.path.splitext(os.path.basename(path))[0]: path
+            for path in sorted(glob.glob(os.path.join(shard_dir, '*.pickle')))}
+
+
+def shard_address(name):
+    return os.path.join(tempfile.gettempdir(), 'hssearch-shard-{}.sock'.format(name))
+
+
+def _authkey():
+    return os.environ[SHARD_KEY_ENV].encode()
+
+
+def phrase_matches(texts, search):
+    """the match rule shared with the HS search: ' search ' inside Text_Proc1"""
+    return pd.Series(texts, dtype=object).str.contains(' ' + search + ' ', regex=False).to_numpy(dtype=bool)
+
+
+def rank(lengths, n_terms, k):
+    """positions of the top-k rows and their scores
+
+    Score is the share of a row's tokens covered by the query, so short,
+    specific lines rank above long ones.
+    """
+    scores = n_terms / np.maximum(lengths, 1)
+    top = np.arange(len(scores))
+    if len(scores) > k:
+        top = np.argpartition(-scores, k)[:k]
+    return top, scores[top]
+
+
+# ===== Shard server =====
+def build_index(df):
+    """inverted index over Text_Proc1: for each token the sorted row ids containing it"""
+    texts = df['Text_Proc1'].astype(object).fillna('').to_numpy()
+    tokens = pd.Series(texts).str.split()
+    pairs = tokens.explode().dropna()
+    pairs = pd.DataFrame({'token': pairs.to_numpy(), 'row': pairs.index.to_numpy()})
+    pairs = pairs.drop_duplicates().sort_values(['token', 'row'])
+    vocab, starts = np.unique(pairs['token'].to_numpy(), return_index=True)
+    return {
+        'terms': {term: i for i, term in enumerate(vocab)},
+        'bounds': np.append(starts, len(pairs)),
+        'rows': pairs['row'].to_numpy(dtype=np.int64),
+        'lengths': tokens.str.len().to_numpy(),
+        'texts': texts,
+        'records': df[SHARD_COLUMNS].reset_index(drop=True),
+    }
+
+
+def _postings(index, term):
+    i = index['terms'].get(term)
+    if i is None:
+        return np.empty(0, dtype=np.int64)
+    return index['rows'][index['bounds'][i]:index['bounds'][i + 1]]
+
+
+def search_shard(index, search, k):
+    """top-k hits of one shard for a processed search string"""
+    terms = search.split()
+    if not terms:
+        return []
+    postings = sorted((_postings(index, term) for term in set(terms)), key=len)
+    rows = postings[0]
+    for p in postings[1:]:
+        rows = np.intersect1d(rows, p, assume_unique=True)
+    rows = rows[phrase_matches(index['texts'][rows], search)]
+    top, scores = rank(index['lengths'][rows], len(terms), k)
+    records = index['records'].iloc[rows[top]].to_dict('records')
+    return [dict(record, Score=round(float(score), 3)) for record, score in zip(records, scores)]
+
+
+def _serve_connection(conn, shard):
+    with conn:
+        try:
+            # authenticate here rather than in the accept loop, so a client
+            # stuck mid-handshake only holds up its own thread
+            deliver_challenge(conn, _authkey())
+            answer_challenge(conn, _authkey())
+        except Exception:
+            return
+        while True:
+            try:
+                request = conn.recv()
+            except (EOFError, OSError):
+                return
+            if request[0] == 'ping':
+                reply = ('ok', shard['mtime'])
+            elif shard['error'] is not None:
+                reply = ('error', shard['error'])
+            else:
+                try:
+                    reply = ('ok', search_shard(shard['index'], *request[1:]))
+                except Exception as e:
+                    reply = ('error', repr(e))
+            try:
+                conn.send(reply)
+            except OSError:
+                # the worker gave up on this query (timeout) and closed the connection
+                return
+
+
+def _lock_path(name):
+    return shard_address(name) + '.lock'
+
+
+def serve_shard(name, path):
+    """index one shard, then answer searches on its socket until killed
+
+    The server holds an exclusive lock (with its pid in the lock file) for
+    its lifetime, so only one server per shard runs on the host.
+    """
+    lock = open(_lock_path(name), 'a+')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        # already served, e.g. two workers restarted the shard at once
+        return
+    lock.seek(0)
+    lock.truncate()
+    lock.write(str(os.getpid()))
+    lock.flush()
+
+    # the pickle's mtime, so a server left over from an older pickle can be told apart
+    shard = {'mtime': os.path.getmtime(path), 'index': None, 'error': None}
+    try:
+        shard['index'] = build_index(pd.read_pickle(path))
+    except Exception as e:
+        # keep serving so workers see the shard as failed instead of missing
+        shard['error'] = repr(e)
+    address = shard_address(name)
+    if os.path.exists(address):
+        os.unlink(address)
+    with Listener(address, family='AF_UNIX') as listener:
+        while True:
+            try:
+                conn = listener.accept()
+            except OSError:
+                continue
+            threading.Thread(target=_serve_connection, args=(conn, shard), daemon=True).start()
+
+
+def _spawn(name, path):
+    # own session, so a Ctrl-C meant for gunicorn or the dev server does not reach it
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), name, path], start_new_session=True)
+
+
+def _stop_server(name, timeout=10):
+    """stop the server holding this shard's lock, if there is one"""
+    try:
+        lock = open(_lock_path(name), 'a+')
+    except OSError:
+        return
+    with lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except OSError:
+            pass
+        lock.seek(0)
+        pid = lock.read().strip()
+        if not pid.isdigit() or int(pid) <= 0:
+            return
+        try:
+            os.kill(int(pid), signal.SIGTERM)
+        except ProcessLookupError:
+            return
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except OSError:
+                time.sleep(0.1)
+
+
+def _open(name):
+    """connect to a shard in a thread; the handshake blocks if the shard stalls"""
+    future = Future()
+
+    def connect():
+        try:
+            future.set_result(Client(shard_address(name), family='AF_UNIX', authkey=_authkey()))
+        except Exception as e:
+            future.set_exception(e)
+    threading.Thread(target=connect, daemon=True).start()
+    return future
+
+
+def _close_late(future):
+    # a connection that finished after its caller gave up on it
+    if future.exception() is None:
+        future.result().close()
+
+
+def _ping(name, timeout=SHARD_TIMEOUT):
+    """mtime of the pickle the running server loaded, None if no server answers"""
+    future = _open(name)
+    futures_wait([future], timeout=timeout)
+    if not future.done():
+        future.add_done_callback(_close_late)
+        return None
+    if future.exception() is not None:
+        return None
+    with future.result() as conn:
+        try:
+            conn.send(('ping',))
+            if conn.poll(timeout):
+                return conn.recv()[1]
+        except Exception:
+            pass
+    return None
+
+
+def start_shard_servers(paths, timeout=SHARD_START_TIMEOUT):
+    """make sure every shard is served from its current pickle, wait until indexed
+
+    A running server is reused only if it answers to our key and loaded the
+    pickle as it is now; otherwise it is stopped and a new one started.
+    """
+    os.environ.setdefault(SHARD_KEY_ENV, secrets.token_hex(16))
+    started = []
+    for name, path in paths.items():
+        if _ping(name) == os.path.getmtime(path):
+            continue
+        _stop_server(name)
+        _spawn(name, path)
+        started.append(name)
+
+    if started:
+        owner = os.getpid()
+
+        def stop():
+            # forked gunicorn workers inherit this handler, only the starter stops
+            # the servers (including any a worker restarted)
+            if os.getpid() == owner:
+                for name in paths:
+                    _stop_server(name)
+        atexit.register(stop)
+
+    deadline = time.monotonic() + timeout
+    pending = set(started)
+    while pending and time.monotonic() < deadline:
+        pending = {name for name in pending if _ping(name) is None}
+        if pending:
+            time.sleep(0.2)
+
+
+# ===== Worker side =====
+def _restart(name, path):
+    """start a server for a shard nobody serves, at most once per SHARD_RESTART_INTERVAL"""
+    now = time.monotonic()
+    if SHARD_KEY_ENV not in os.environ or now - _restarted.get(name, -SHARD_RESTART_INTERVAL) < SHARD_RESTART_INTERVAL:
+        return
+    _restarted[name] = now
+    _spawn(name, path)
+
+
+def _ask(name, path, search, k, start):
+    """one shard's whole exchange (connect, query, answer), run in its own thread
+
+    Returns (state, hits, seconds, conn). The thread owns the connection until
+    it returns, so a late answer never ends up on a connection in use.
+    """
+    conn = _connections.pop(name, None)
+    try:
+        if conn is not None:
+            try:
+                conn.send(('search', search, k))
+                state, payload = conn.recv()
+            except (EOFError, OSError):
+                # the server behind the kept connection went away (crash or
+                # replacement), try a fresh one below
+                conn.close()
+                conn = None
+        if conn is None:
+            conn = Client(shard_address(name), family='AF_UNIX', authkey=_authkey())
+            conn.send(('search', search, k))
+            state, payload = conn.recv()
+    except (FileNotFoundError, ConnectionRefusedError):
+        # no server listening: it crashed or was never started
+        _restart(name, path)
+        return 'unavailable', [], None, None
+    except Exception:
+        if conn is not None:
+            conn.close()
+        return 'unavailable', [], None, None
+    elapsed = time.perf_counter() - start
+    if state != 'ok':
+        return 'failed', [], elapsed, conn
+    return 'ok', [dict(hit, Shard=name) for hit in payload], elapsed, conn
+
+
+def _close_when_done(future):
+    # answer that came after the search gave up on this shard
+    conn = future.result()[3]
+    if conn is not None:
+        conn.close()
+
+
+def search_shards(paths, search, k=50, timeout=SHARD_TIMEOUT):
+    """scatter the search to every shard, gather the merged top-k
+
+    Returns (hits, status). status maps each shard name to (state, seconds),
+    state being 'ok', 'failed', 'timed out' or 'unavailable'. seconds is
+    measured here, from the start of the search (including connecting) to
+    the shard's answer, and everything runs under the one timeout.
+    """
+    with _lock:
+        start = time.perf_counter()
+        futures = {}
+        for name, path in paths.items():
+            future = Future()
+            futures[name] = future
+
+            def run(future=future, name=name, path=path):
+                future.set_result(_ask(name, path, search, k, start))
+            threading.Thread(target=run, daemon=True).start()
+        futures_wait(list(futures.values()), timeout=timeout)
+
+        hits, status = [], {}
+        for name, future in futures.items():
+            if not future.done():
+                future.add_done_callback(_close_when_done)
+                status[name] = ('timed out', time.perf_counter() - start)
+                continue
+            state, shard_hits, elapsed, conn = future.result()
+            if conn is not None:
+                _connections[name] = conn
+            hits.extend(shard_hits)
+            status[name] = (state, elapsed)
+
+    return heapq.nlargest(k, hits, key=lambda hit: hit['Score']), status
+
+
+if __name__ == '__main__':
+    serve_shard(sys.argv[1], sys.argv[2])